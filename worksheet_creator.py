@@ -4,14 +4,15 @@ import os
 from dotenv import load_dotenv
 import re
 import tempfile
-from pylatex import Document, Command, Package
-from pylatex.utils import NoEscape
 import base64
 from pathlib import Path
 import shutil
 import subprocess
 import sys
 import platform
+import hashlib
+import json
+import time
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,6 +26,95 @@ st.set_page_config(
 # Get API key from environment variable
 api_key = os.getenv("OPENAI_API_KEY")
 
+# Directory where OpenAI responses are cached between runs
+CACHE_DIR = Path(tempfile.gettempdir()) / "ws_cache"
+
+# Line separating the Markdown worksheet from its LaTeX version in the model output
+LATEX_SEPARATOR = "===LATEX==="
+
+# Minimum number of seconds between streaming preview updates
+STREAM_UPDATE_INTERVAL = 0.25
+
+# Matches a Markdown code fence the model may still wrap the LaTeX section in
+_RE_CODE_FENCE = re.compile(r'^```[\w-]*[ \t]*\n?|\n?```$')
+
+# Commands that need a second pdflatex pass to resolve
+_RE_CROSSREF = re.compile(
+    r'\\(?:(?:page|eq|auto)?ref|cite|tableofcontents|listoffigures|listoftables)\b'
+)
+
+# Prompt used to generate the worksheet, filled in with the form inputs
+_PROMPT_TEMPLATE = """
+You are an advanced educational content generator tasked with creating high-quality worksheets.
+
+### Input Variables
+
+1. **Subject/Topic:** {subject}
+   - A brief description of the primary subject or topic of the worksheets.
+
+2. **Target Audience (Grade/Age Level):** {grade_level}
+   - The grade range, age group, or skill level of the students.
+
+3. **Learning Objectives:** {learning_objectives}
+   - A list or description of the key learning goals or competencies students should achieve.
+
+4. **Required Sections:**  
+   - **Instructions** (clear, concise, and engaging)  
+   - **Examples** (illustrative and aligned with the topic)  
+   - **Practice Exercises** (varied question types, skill-based, and scaffolded)  
+   - **Real-Life Applications** (contextual, practical exercises linking to everyday scenarios)
+
+5. **Optional Details:** {optional_details}
+   - Any specific themes, difficulty levels, time constraints, or style guidelines.
+
+### Task (In Detail)
+
+1. **Generate Worksheets:**  
+   - Create a set of worksheets tailored to the subject for students at the specified grade level. Incorporate the specified learning objectives.  
+
+2. **Structure and Flow:**  
+   - The worksheets **must** include the four core sections (Instructions, Examples, Practice Exercises, Real-Life Applications).  
+   - Clearly label each section and provide smooth transitions so students can follow along effortlessly.
+
+3. **Activity Design:**  
+   - Craft engaging activities that encourage critical thinking, problem-solving, and hands-on practice.  
+   - Vary question formats (e.g., multiple choice, fill-in-the-blank, matching, short answer, and open-ended).  
+
+4. **Customization and Style:**  
+   - Integrate any extra guidelines or stylistic preferences provided in optional details.  
+   - Ensure the final output is well-formatted with clear headings and consistent spacing.
+
+### Return Format
+
+- **Title** and/or **Topic Heading**  
+- **Brief Introduction** or overview of what the worksheets will cover  
+- **Instructions** (a short paragraph explaining how to use the worksheet)  
+- **Examples** (one or more detailed examples illustrating key points)  
+- **Practice Exercises** (clearly numbered or labeled questions with sufficient space or lines for answers)  
+- **Real-Life Applications** (at least one scenario-based question or activity linking to everyday experiences)  
+- **Answer Key** (optional, but recommended if appropriate)  
+
+### Warnings, Precautions, and Guidelines
+
+1. **Age/Grade Appropriateness:**  
+   - The content must be aligned with the grade level and free of inappropriate material.
+
+2. **Clarity and Accessibility:**  
+   - Instructions and questions should be easy to understand for non-native speakers and diverse learners.
+
+3. **Accuracy and Relevance:**  
+   - Ensure all factual details are correct and directly related to the subject and learning objectives.  
+
+4. **Bias and Inclusion:**  
+   - Avoid cultural, racial, or gender biases. Use inclusive language and examples whenever possible.
+
+5. **Copyright and Plagiarism:**  
+   - Only use material you have permission to use. Avoid directly copying large segments from external sources.
+
+6. **Formatting:**  
+   - The final layout must accommodate clear headings and consistent spacing for easy reading and printing.
+"""
+
 # Sidebar for info
 with st.sidebar:
     st.header("About")
@@ -98,10 +188,128 @@ def prepare_latex_for_rendering(latex_content):
     
     return latex_content.strip()
 
-# Function to convert LaTeX to PDF using PyLaTeX and return the PDF bytes
+# Helper function to pull the LaTeX section out of the model response
+def extract_latex_section(response_content):
+    """
+    Return the LaTeX section of the model response without any code fence.
+    
+    Args:
+        response_content (str): The full model response.
+        
+    Returns:
+        str: The LaTeX section, or an empty string if the separator is missing.
+    """
+    latex_content = response_content.partition(LATEX_SEPARATOR)[2].strip()
+    return _RE_CODE_FENCE.sub('', latex_content).strip()
+
+# Helper function to call the OpenAI chat API with a persistent response cache
+def cached_chat(client, messages, model, on_chunk=None, validate=None, **kwargs):
+    """
+    Return the content of a chat completion, reusing a cached response if the
+    same request has been made before.
+    
+    Args:
+        client (OpenAI): The OpenAI client used on a cache miss.
+        messages (list): The chat messages to send.
+        model (str): The model name.
+        on_chunk (callable, optional): If given, the response is streamed and this
+            is called with the content received so far, at most once every
+            STREAM_UPDATE_INTERVAL seconds and once more when the stream ends.
+        validate (callable, optional): If given, a response is only cached when
+            this returns True for it, so incomplete responses are retried.
+        **kwargs: Extra arguments passed to client.chat.completions.create.
+        
+    Returns:
+        str or None: The response content, or None if the API returned no choices.
+    """
+    # Key the cache on everything that affects the response
+    key = hashlib.sha256(
+        json.dumps({"model": model, "messages": messages, **kwargs}, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    cache_path = CACHE_DIR / f"{key}.json"
+    
+    if cache_path.exists():
+        try:
+            with open(cache_path, "r", encoding="utf-8") as cache_file:
+                return json.load(cache_file)["content"]
+        except (OSError, ValueError, KeyError):
+            # Ignore unreadable cache entries and fall through to the API
+            pass
+    
+    if on_chunk is None:
+        response = client.chat.completions.create(model=model, messages=messages, **kwargs)
+        if not response or not response.choices:
+            return None
+        
+        content = response.choices[0].message.content
+    else:
+        # Stream the response, reporting progress periodically rather than per
+        # chunk so the content isn't re-joined and re-rendered for every token
+        chunks = []
+        last_update = time.monotonic()
+        stream = client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+        for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                chunks.append(event.choices[0].delta.content)
+                if time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL:
+                    on_chunk("".join(chunks))
+                    last_update = time.monotonic()
+        
+        content = "".join(chunks)
+        on_chunk(content)
+    
+    if content and (validate is None or validate(content)):
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as cache_file:
+                json.dump({"content": content}, cache_file)
+        except OSError:
+            # Caching is best-effort; a read-only temp dir shouldn't break generation
+            pass
+    
+    return content
+
+# Helper function to locate pdflatex
+# Streamlit re-executes this script on every rerun, so the PATH search is cached
+# as a resource to run once per server process
+@st.cache_resource(show_spinner=False)
+def find_pdflatex():
+    """
+    Find the pdflatex executable on the system path.
+    
+    Returns:
+        str or None: The full path to pdflatex, or None if it is not installed.
+    """
+    return shutil.which("pdflatex")
+
+# Helper function to pull the error message out of a pdflatex log file
+def read_pdflatex_error(log_path):
+    """
+    Return the first error reported in a pdflatex log file.
+    
+    Args:
+        log_path (Path): Path to the .log file written by pdflatex.
+        
+    Returns:
+        str or None: The log from the first error line onwards, or None if
+        the log is missing or contains no error.
+    """
+    try:
+        log = log_path.read_text(encoding="utf-8", errors="replace")
+    except OSError:
+        return None
+    
+    # pdflatex marks error lines with a leading "!"
+    error_start = log.find("\n!")
+    if error_start < 0:
+        return None
+    return log[error_start + 1:].strip()
+
+# Function to convert LaTeX to PDF with pdflatex and return the PDF bytes
+@st.cache_data(show_spinner=False, max_entries=32)
 def convert_latex_to_pdf(latex_content):
     """
-    Convert LaTeX content to PDF using PyLaTeX.
+    Convert LaTeX content to PDF by running pdflatex in a subprocess.
     
     Args:
         latex_content (str): The LaTeX content to convert.
@@ -113,177 +321,111 @@ def convert_latex_to_pdf(latex_content):
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_dir_path = Path(temp_dir)
         
-        # Two approaches: direct PyLaTeX or subprocess with pdflatex
-        # Try PyLaTeX first, fall back to subprocess if needed
-        
         try:
-            # Approach 1: Use PyLaTeX to create a document
-            # This is the preferred method for Streamlit Cloud
-            
-            # Extract document class if present, or use default
-            doc_class_match = re.search(r'\\documentclass(\[.*?\])?\{(.*?)\}', latex_content)
-            if doc_class_match:
-                doc_class = doc_class_match.group(2)
-                # Remove the document class from content as we'll add it via PyLaTeX
-                latex_content = re.sub(r'\\documentclass(\[.*?\])?\{.*?\}', '', latex_content)
-            else:
-                doc_class = 'article'
-            
-            # Remove begin/end document tags if present
-            latex_content = re.sub(r'\\begin\{document\}', '', latex_content)
-            latex_content = re.sub(r'\\end\{document\}', '', latex_content)
-            
-            # Create PyLaTeX document
-            doc = Document(documentclass=doc_class)
+            # Path for the temporary tex file
+            tex_file_path = temp_dir_path / "worksheet.tex"
             
-            # Add common packages that might be needed
-            doc.packages.append(Package('amsmath'))
-            doc.packages.append(Package('amssymb'))
-            doc.packages.append(Package('graphicx'))
-            doc.packages.append(Package('geometry', options=['margin=1in']))
-            
-            # Extract and add any usepackage commands
-            package_matches = re.finditer(r'\\usepackage(\[.*?\])?\{(.*?)\}', latex_content)
-            for match in package_matches:
-                options_str = match.group(1)
-                package_name = match.group(2)
-                
-                # Process options if present
-                options = []
-                if options_str:
-                    # Remove brackets and split by comma
-                    options_str = options_str[1:-1]  # Remove [ and ]
-                    options = [opt.strip() for opt in options_str.split(',')]
+            # Write the LaTeX content to the tex file
+            with open(tex_file_path, "w", encoding="utf-8") as tex_file:
+                # Make sure the LaTeX content has proper document structure
+                if "\\documentclass" not in latex_content:
+                    # Add document class if missing
+                    latex_content = "\\documentclass{article}\n\\usepackage{amsmath,amssymb,graphicx}\n\\begin{document}\n" + latex_content
                 
-                # Add package to document
-                doc.packages.append(Package(package_name, options=options))
+                if "\\end{document}" not in latex_content:
+                    # Add end document if missing
+                    latex_content = latex_content + "\n\\end{document}"
+                    
+                tex_file.write(latex_content)
             
-            # Remove usepackage commands from content as we've added them via PyLaTeX
-            latex_content = re.sub(r'\\usepackage(\[.*?\])?\{.*?\}', '', latex_content)
+            # Check if pdflatex is available
+            pdflatex_path = find_pdflatex()
             
-            # Add the remaining content as NoEscape to prevent escaping of LaTeX commands
-            doc.append(NoEscape(latex_content))
+            if pdflatex_path is None:
+                raise Exception("pdflatex is not available in the system path")
             
-            # Generate PDF
-            output_filename = str(temp_dir_path / "worksheet")
+            # Run pdflatex with specific options to avoid MiKTeX update checks
+            env = os.environ.copy()
+            if platform.system() == "Windows":
+                # Disable MiKTeX update check on Windows
+                env["MIKTEX_NOASK"] = "1"
             
-            # For Streamlit Cloud, we need to specify compiler explicitly
-            # and avoid using latexmk which might not be available
-            try:
-                doc.generate_pdf(
-                    output_filename, 
-                    clean_tex=False,
-                    compiler='pdflatex',  # Use pdflatex directly instead of latexmk
-                    compiler_args=[
-                        '-interaction=nonstopmode',
-                        '-halt-on-error'
-                    ]
-                )
-            except Exception as compiler_error:
-                # If the default compiler fails, try with a different approach
-                st.warning(f"First compilation attempt failed: {str(compiler_error)}. Trying with different settings...")
-                
-                # Write the TeX file directly
-                tex_path = temp_dir_path / "worksheet.tex"
-                doc.generate_tex(str(tex_path))
-                
-                # Run pdflatex manually
-                subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", "-output-directory", 
-                     str(temp_dir_path), str(tex_path)],
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
+            # batchmode keeps pdflatex quiet; errors are read back from the log
+            pdflatex_args = ["-interaction=batchmode", "-halt-on-error", "-output-directory",
+                             str(temp_dir_path), str(tex_file_path)]
             
-            # Read the generated PDF
-            pdf_path = temp_dir_path / "worksheet.pdf"
-            if pdf_path.exists():
-                with open(pdf_path, "rb") as pdf_file:
-                    return pdf_file.read()
-            else:
-                # If PyLaTeX approach failed, try the subprocess approach
-                raise FileNotFoundError("PDF not generated by PyLaTeX")
-                
-        except Exception as pylatex_error:
-            st.warning(f"PyLaTeX approach failed: {str(pylatex_error)}. Trying alternative approach...")
+            # Run pdflatex only once to avoid font generation issues. Only worksheets
+            # with cross-references need a pass before that; it just writes the .aux
+            # file, so skip PDF output there
+            commands = [[pdflatex_path] + pdflatex_args]
+            if _RE_CROSSREF.search(latex_content):
+                commands.insert(0, [pdflatex_path, "-draftmode"] + pdflatex_args)
             
-            try:
-                # Approach 2: Use subprocess to call pdflatex directly
-                # This is a fallback for environments where pdflatex is available
-                
-                # Path for the temporary tex file
-                tex_file_path = temp_dir_path / "worksheet.tex"
-                
-                # Write the LaTeX content to the tex file
-                with open(tex_file_path, "w", encoding="utf-8") as tex_file:
-                    # Make sure the LaTeX content has proper document structure
-                    if "\\documentclass" not in latex_content:
-                        # Add document class if missing
-                        latex_content = "\\documentclass{article}\n\\usepackage{amsmath,amssymb,graphicx}\n\\begin{document}\n" + latex_content
-                    
-                    if "\\end{document}" not in latex_content:
-                        # Add end document if missing
-                        latex_content = latex_content + "\n\\end{document}"
-                        
-                    tex_file.write(latex_content)
-                
-                # Check if pdflatex is available
-                try:
-                    # Different command check based on OS
-                    if platform.system() == "Windows":
-                        check_cmd = ["where", "pdflatex"]
-                    else:
-                        check_cmd = ["which", "pdflatex"]
-                    
-                    subprocess.run(check_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    pdflatex_available = True
-                except subprocess.CalledProcessError:
-                    pdflatex_available = False
-                
-                if not pdflatex_available:
-                    raise Exception("pdflatex is not available in the system path")
-                
-                # Run pdflatex with specific options to avoid MiKTeX update checks
-                env = os.environ.copy()
-                if platform.system() == "Windows":
-                    # Disable MiKTeX update check on Windows
-                    env["MIKTEX_NOASK"] = "1"
-                
-                # Run pdflatex only once to avoid font generation issues
-                subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", "-output-directory", 
-                     str(temp_dir_path), str(tex_file_path)],
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
+            # Check the return code directly rather than raising CalledProcessError
+            for command in commands:
+                returncode = subprocess.run(
+                    command,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
                     env=env
-                )
+                ).returncode
+                if returncode != 0:
+                    break
                 
-                # Read the generated PDF
-                pdf_path = temp_dir_path / "worksheet.pdf"
-                if pdf_path.exists():
-                    with open(pdf_path, "rb") as pdf_file:
-                        return pdf_file.read()
-                else:
-                    raise Exception("PDF was not generated successfully")
-                    
-            except subprocess.CalledProcessError as e:
-                error_output = e.stderr.decode('utf-8') if e.stderr else 'Unknown error'
-                # Truncate error message if it's too long
-                if len(error_output) > 500:
-                    error_output = error_output[:500] + "... (error message truncated)"
-                raise Exception(f"PDF generation failed: {error_output}")
-            except Exception as e:
-                raise Exception(f"Error during PDF conversion: {str(e)}")
+        except Exception as e:
+            raise Exception(f"Error during PDF conversion: {str(e)}")
+        
+        if returncode != 0:
+            # Output is discarded on the happy path, so the log has the error details
+            error_output = read_pdflatex_error(temp_dir_path / "worksheet.log")
+            if not error_output:
+                error_output = f"pdflatex exited with status {returncode}"
+            # Truncate error message if it's too long
+            if len(error_output) > 500:
+                error_output = error_output[:500] + "... (error message truncated)"
+            raise Exception(f"PDF generation failed: {error_output}")
+        
+        # Read the generated PDF
+        pdf_path = temp_dir_path / "worksheet.pdf"
+        if not pdf_path.exists():
+            raise Exception("Error during PDF conversion: PDF was not generated successfully")
+        with open(pdf_path, "rb") as pdf_file:
+            return pdf_file.read()
+
+# Helper function to build the iframe used to display a PDF
+# cache_resource hands back the stored string itself; cache_data would unpickle
+# a fresh multi-MB copy of the base64 payload on every rerun
+@st.cache_resource(show_spinner=False, max_entries=32)
+def pdf_to_iframe_html(pdf_bytes):
+    """
+    Build an iframe that embeds PDF bytes as a base64 data URI.
+    
+    Args:
+        pdf_bytes (bytes): The PDF file content.
+        
+    Returns:
+        str: HTML for an iframe displaying the PDF.
+    """
+    base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
+    return f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="600" type="application/pdf"></iframe>'
 
 # Handle form submission
 if submit_button:
+    # Identifies the inputs a stored result was generated from
+    result_key = hash((subject, grade_level, learning_objectives, optional_details))
+    
     if not api_key:
         st.error("OpenAI API key not found. Please add your OPENAI_API_KEY to the .env file.")
+        # Don't show the previous worksheet under the error
+        st.session_state.pop("result", None)
     elif not subject or not grade_level or not learning_objectives:
         st.error("Please fill in all required fields (Subject, Grade Level, and Learning Objectives)")
-    else:
+        st.session_state.pop("result", None)
+    elif st.session_state.get("result", {}).get("key") != result_key:
+        # Resubmitting the same inputs falls through to the result shown below.
+        # Otherwise drop the previous worksheet so it isn't shown if generation fails
+        st.session_state.pop("result", None)
+        
         try:
             # Initialize OpenAI client
             client = OpenAI(api_key=api_key)
@@ -291,131 +433,71 @@ if submit_button:
             # Status container for progress updates
             status_container = st.empty()
             
-            # First API call - Generate worksheet content
-            with st.spinner("Step 1/2: Generating worksheet content using OpenAI..."):
+            # Single API call - Generate worksheet content and its LaTeX version
+            with st.spinner("Generating worksheet content and LaTeX using OpenAI..."):
                 status_container.info("Creating educational worksheet based on your inputs. This may take a moment...")
                 
                 # Construct the prompt
-                prompt = f"""
-                You are an advanced educational content generator tasked with creating high-quality worksheets.
-
-                ### Input Variables
-
-                1. **Subject/Topic:** {subject}
-                   - A brief description of the primary subject or topic of the worksheets.
-
-                2. **Target Audience (Grade/Age Level):** {grade_level}
-                   - The grade range, age group, or skill level of the students.
-
-                3. **Learning Objectives:** {learning_objectives}
-                   - A list or description of the key learning goals or competencies students should achieve.
-
-                4. **Required Sections:**  
-                   - **Instructions** (clear, concise, and engaging)  
-                   - **Examples** (illustrative and aligned with the topic)  
-                   - **Practice Exercises** (varied question types, skill-based, and scaffolded)  
-                   - **Real-Life Applications** (contextual, practical exercises linking to everyday scenarios)
-
-                5. **Optional Details:** {optional_details}
-                   - Any specific themes, difficulty levels, time constraints, or style guidelines.
-
-                ### Task (In Detail)
-
-                1. **Generate Worksheets:**  
-                   - Create a set of worksheets tailored to the subject for students at the specified grade level. Incorporate the specified learning objectives.  
-
-                2. **Structure and Flow:**  
-                   - The worksheets **must** include the four core sections (Instructions, Examples, Practice Exercises, Real-Life Applications).  
-                   - Clearly label each section and provide smooth transitions so students can follow along effortlessly.
-
-                3. **Activity Design:**  
-                   - Craft engaging activities that encourage critical thinking, problem-solving, and hands-on practice.  
-                   - Vary question formats (e.g., multiple choice, fill-in-the-blank, matching, short answer, and open-ended).  
-
-                4. **Customization and Style:**  
-                   - Integrate any extra guidelines or stylistic preferences provided in optional details.  
-                   - Ensure the final output is well-formatted with clear headings and consistent spacing.
-
-                ### Return Format
-
-                - **Title** and/or **Topic Heading**  
-                - **Brief Introduction** or overview of what the worksheets will cover  
-                - **Instructions** (a short paragraph explaining how to use the worksheet)  
-                - **Examples** (one or more detailed examples illustrating key points)  
-                - **Practice Exercises** (clearly numbered or labeled questions with sufficient space or lines for answers)  
-                - **Real-Life Applications** (at least one scenario-based question or activity linking to everyday experiences)  
-                - **Answer Key** (optional, but recommended if appropriate)  
-
-                ### Warnings, Precautions, and Guidelines
-
-                1. **Age/Grade Appropriateness:**  
-                   - The content must be aligned with the grade level and free of inappropriate material.
-
-                2. **Clarity and Accessibility:**  
-                   - Instructions and questions should be easy to understand for non-native speakers and diverse learners.
-
-                3. **Accuracy and Relevance:**  
-                   - Ensure all factual details are correct and directly related to the subject and learning objectives.  
-
-                4. **Bias and Inclusion:**  
-                   - Avoid cultural, racial, or gender biases. Use inclusive language and examples whenever possible.
-
-                5. **Copyright and Plagiarism:**  
-                   - Only use material you have permission to use. Avoid directly copying large segments from external sources.
-
-                6. **Formatting:**  
-                   - The final layout must accommodate clear headings and consistent spacing for easy reading and printing.
-                """
-                
-                # Make the API call
-                response = client.chat.completions.create(
-                    model="o3-mini-2025-01-31",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ],
-                    response_format={"type": "text"},
-                    reasoning_effort="high"
+                prompt = _PROMPT_TEMPLATE.format(
+                    subject=subject,
+                    grade_level=grade_level,
+                    learning_objectives=learning_objectives,
+                    optional_details=optional_details,
                 )
                 
-                # Extract the response
-                if response and response.choices:
-                    worksheet_content = response.choices[0].message.content
-                    status_container.success("✅ Worksheet content generated successfully!")
-                else:
+                # Show the Markdown part of the response as it streams in
+                preview_container = st.empty()
+                
+                def show_preview(content):
+                    worksheet_part, separator, _ = content.partition(LATEX_SEPARATOR)
+                    if not separator:
+                        preview_container.markdown(worksheet_part)
+                
+                # Make the API call (cached on the exact prompt)
+                try:
+                    response_content = cached_chat(
+                        client,
+                        on_chunk=show_preview,
+                        # Don't cache responses without a LaTeX section so they can be retried
+                        validate=lambda content: bool(extract_latex_section(content)),
+                        model="o3-mini-2025-01-31",
+                        messages=[
+                            {
+                                "role": "system",
+                                "content": (
+                                    f"Output two sections separated by a line containing only {LATEX_SEPARATOR}: "
+                                    "first the worksheet in Markdown, then the same worksheet as a complete LaTeX document. "
+                                    "Return Latex Only in the second section, without Markdown code fences."
+                                )
+                            },
+                            {
+                                "role": "user",
+                                "content": [
+                                    {
+                                        "type": "text",
+                                        "text": prompt
+                                    }
+                                ]
+                            }
+                        ],
+                        response_format={"type": "text"},
+                        reasoning_effort="high"
+                    )
+                finally:
+                    # The preview is replaced by the tabs below, or by the error
+                    # message if the request fails part-way through
+                    preview_container.empty()
+                
+                # Check the response
+                if not response_content:
                     st.error("Failed to generate worksheet. Please try again.")
                     st.stop()
-            
-            # Second API call - Convert to LaTeX
-            with st.spinner("Step 2/2: Converting worksheet to LaTeX format..."):
-                status_container.info("Converting the worksheet to LaTeX format. This may take a moment...")
                 
-                latex_response = client.chat.completions.create(
-                    model="o3-mini-2025-01-31",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Return Content as Latex. Return Latex Only."
-                        },
-                        {
-                            "role": "user",
-                            "content": worksheet_content
-                        }
-                    ],
-                    response_format={"type": "text"},
-                    reasoning_effort="high"
-                )
-                
-                # Extract the LaTeX content
-                if latex_response and latex_response.choices:
-                    latex_content = latex_response.choices[0].message.content
+                # Split the response into the Markdown and LaTeX sections
+                worksheet_content = response_content.partition(LATEX_SEPARATOR)[0].strip()
+                latex_content = extract_latex_section(response_content)
+                latex_converted = bool(latex_content)
+                if latex_converted:
                     status_container.success("✅ Worksheet generated and converted to LaTeX successfully!")
                 else:
                     latex_content = "Failed to convert to LaTeX"
@@ -424,54 +506,87 @@ if submit_button:
             # Clear the status container
             status_container.empty()
             
-            # Create tabs for different formats (removed LaTeX tab)
-            tab1, tab2 = st.tabs(["Markdown", "PDF"])
-            
-            with tab1:
-                st.subheader("Markdown Format")
-                st.code(worksheet_content, language="markdown")
-                st.download_button(
-                    label="Download Markdown",
-                    data=worksheet_content,
-                    file_name=f"{subject.replace(' ', '_')}_worksheet.md",
-                    mime="text/markdown",
-                )
-            
-            with tab2:
-                st.subheader("PDF Format")
+            # Keep the result in session state so it survives the reruns
+            # triggered by widgets on the result page
+            st.session_state["result"] = {
+                # Failed conversions get no key so resubmitting the same inputs retries
+                "key": result_key if latex_converted else None,
+                "file_stem": f"{subject.replace(' ', '_')}_worksheet",
+                "worksheet": worksheet_content,
+                "latex": latex_content,
+                # Encoded once so download buttons don't re-encode it every rerun
+                "latex_bytes": latex_content.encode("utf-8"),
+                "pdf_requested": False,
+            }
                 
+        except Exception as e:
+            st.error(f"An error occurred: {str(e)}")
+
+# Show the most recently generated worksheet
+if "result" in st.session_state:
+    result = st.session_state["result"]
+    file_stem = result["file_stem"]
+    worksheet_content = result["worksheet"]
+    latex_content = result["latex"]
+    
+    # Create tabs for different formats (removed LaTeX tab)
+    tab1, tab2 = st.tabs(["Markdown", "PDF"])
+    
+    with tab1:
+        st.subheader("Markdown Format")
+        st.code(worksheet_content, language="markdown")
+        st.download_button(
+            label="Download Markdown",
+            data=worksheet_content,
+            file_name=f"{file_stem}.md",
+            mime="text/markdown",
+        )
+    
+    with tab2:
+        st.subheader("PDF Format")
+        
+        # PDF generation runs pdflatex, so only do it once the user asks for it
+        if not result["pdf_requested"]:
+            result["pdf_requested"] = st.button("Generate PDF")
+        
+        if result["pdf_requested"]:
+            # Compile at most once per request; the outcome is kept in the result so
+            # reruns (e.g. from the download buttons) don't run pdflatex again
+            if "pdf" not in result and "pdf_error" not in result:
                 try:
                     # Show status while generating PDF
                     with st.spinner("Generating PDF..."):
-                        pdf_bytes = convert_latex_to_pdf(latex_content)
-                    
-                    # Create a download button for the PDF
-                    st.download_button(
-                        label="Download PDF",
-                        data=pdf_bytes,
-                        file_name=f"{subject.replace(' ', '_')}_worksheet.pdf",
-                        mime="application/pdf",
-                    )
-                    
-                    # Display PDF directly in Streamlit
-                    # Encode PDF to base64 for displaying in an iframe
-                    base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
-                    pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="600" type="application/pdf"></iframe>'
-                    st.markdown(pdf_display, unsafe_allow_html=True)
-                    
+                        result["pdf"] = convert_latex_to_pdf(latex_content)
                 except Exception as pdf_error:
-                    st.error(f"Could not generate PDF: {str(pdf_error)}")
-                    st.info("PDF generation requires LaTeX to be installed. For Streamlit Cloud deployment, you may need to add LaTeX to the packages.txt file.")
-                    
-                    # Provide a link to download just the LaTeX file as a fallback
-                    st.markdown("### Fallback Option")
-                    st.markdown("If PDF generation is not working, you can download the LaTeX file and compile it locally:")
-                    st.download_button(
-                        label="Download LaTeX File",
-                        data=latex_content,
-                        file_name=f"{subject.replace(' ', '_')}_worksheet.tex",
-                        mime="text/plain",
-                    )
+                    result["pdf_error"] = str(pdf_error)
+            
+            if "pdf" in result:
+                # Create a download button for the PDF
+                st.download_button(
+                    label="Download PDF",
+                    data=result["pdf"],
+                    file_name=f"{file_stem}.pdf",
+                    mime="application/pdf",
+                )
                 
-        except Exception as e:
-            st.error(f"An error occurred: {str(e)}") 
\ No newline at end of file
+                # Display PDF directly in Streamlit
+                st.markdown(pdf_to_iframe_html(result["pdf"]), unsafe_allow_html=True)
+                
+            else:
+                st.error(f"Could not generate PDF: {result['pdf_error']}")
+                st.info("PDF generation requires LaTeX to be installed. For Streamlit Cloud deployment, you may need to add LaTeX to the packages.txt file.")
+                
+                # Let the user try the compile again explicitly
+                if st.button("Retry PDF Generation"):
+                    del result["pdf_error"]
+                    st.rerun()
+                
+                # Provide a link to download just the LaTeX file as a fallback
+                st.markdown("### Fallback Option")
+                st.markdown("If PDF generation is not working, you can download the LaTeX file and compile it locally:")
+                st.download_button(
+                    label="Download LaTeX File",
+                    data=result["latex_bytes"],
+                    file_name=f"{file_stem}.tex",
+                    mime="text/plain",
+                )